@@ -1,6 +1,14 @@
+import gzip
+import hashlib
+import json
+import math
 import os
+import smtplib
+import threading
+import time
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from email.message import EmailMessage
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 from flask import send_from_directory
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -11,6 +19,19 @@ app.secret_key = 'votre_cle_secrete_ici'  # À changer en production
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB max
 
+# Configuration de l'envoi des emails (serveur SMTP)
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))
+app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '0') == '1'
+app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', 'contact@agence-voyage.com')
+app.config['MAIL_TIMEOUT'] = 10  # secondes
+app.config['MAIL_BATCH_SIZE'] = 50  # emails envoyés par connexion SMTP
+app.config['MAIL_POLL_INTERVAL'] = 5  # secondes entre deux vérifications de la file
+app.config['MAIL_MAX_TENTATIVES'] = 6  # au-delà, l'email part en lettres mortes
+app.config['MAIL_DELAI_BASE'] = 30  # secondes, doublé à chaque échec
+
 # Extensions autorisées pour les images
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
@@ -87,6 +108,42 @@ def init_db():
         )
     ''')
     
+    # Index utilisés par la pagination de l'API
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_destinations_prix ON destinations (prix)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_commentaires_approuve_date ON commentaires (approuve, date)')
+    
+    # File d'attente des emails sortants
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS emails_en_attente (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            destinataire TEXT NOT NULL,
+            sujet TEXT NOT NULL,
+            corps TEXT NOT NULL,
+            tentatives INTEGER DEFAULT 0,
+            prochain_essai REAL NOT NULL,
+            derniere_erreur TEXT,
+            date_creation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_emails_prochain_essai
+        ON emails_en_attente (prochain_essai)
+    ''')
+    
+    # Emails abandonnés après trop d'échecs (lettres mortes)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS emails_echoues (
+            id INTEGER PRIMARY KEY,
+            destinataire TEXT NOT NULL,
+            sujet TEXT NOT NULL,
+            corps TEXT NOT NULL,
+            tentatives INTEGER NOT NULL,
+            derniere_erreur TEXT,
+            date_creation TIMESTAMP,
+            date_echec TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
     # Vérifier si l'admin existe
     cursor.execute('SELECT * FROM users WHERE username = ?', ('admin',))
     if not cursor.fetchone():
@@ -134,6 +191,210 @@ def get_db_connection():
 # Initialiser la base de données
 init_db()
 
+# ============================================
+# FILE D'ATTENTE DES EMAILS
+# ============================================
+
+# Les emails ne sont jamais envoyés pendant une requête : ils sont enregistrés
+# dans la table emails_en_attente, puis expédiés par lots par un thread en
+# arrière-plan qui réutilise la même connexion SMTP.
+_COMMANDES_SMTP_PAR_EMAIL = 5  # NOOP/RSET, MAIL FROM, RCPT TO, DATA, fin du message
+
+_expediteur_thread = None
+_expediteur_lock = threading.Lock()
+_expediteur_reveil = threading.Event()
+
+def mettre_email_en_attente(conn, destinataire, sujet, corps):
+    """Ajoute un email à la file d'attente, dans la transaction de l'appelant"""
+    conn.execute('''
+        INSERT INTO emails_en_attente (destinataire, sujet, corps, prochain_essai)
+        VALUES (?, ?, ?, ?)
+    ''', (destinataire, sujet, corps, time.time()))
+
+def reveiller_expediteur():
+    """Signale à l'expéditeur que de nouveaux emails ont été validés en base"""
+    _expediteur_reveil.set()
+
+def _duree_reservation():
+    """Durée pendant laquelle les emails réservés ne sont pas repris par un autre processus.
+    
+    Elle couvre l'envoi d'un seul email (plus l'ouverture de la connexion) dans
+    le pire cas ; la réservation des emails restants est prolongée après chaque
+    envoi, si bien qu'un processus arrêté en plein lot ne les bloque pas longtemps.
+    """
+    return 2 * _COMMANDES_SMTP_PAR_EMAIL * app.config['MAIL_TIMEOUT']
+
+def _prolonger_reservation(conn, emails):
+    """Prolonge la réservation des emails du lot qui restent à envoyer"""
+    fin_reservation = time.time() + _duree_reservation()
+    conn.executemany('UPDATE emails_en_attente SET prochain_essai = ? WHERE id = ?',
+                     [(fin_reservation, email['id']) for email in emails])
+
+def _reserver_lot_emails(conn, taille):
+    """Réserve un lot d'emails à envoyer pour éviter les doublons entre processus"""
+    maintenant = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    emails = conn.execute('''
+        SELECT * FROM emails_en_attente 
+        WHERE prochain_essai <= ? 
+        ORDER BY prochain_essai 
+        LIMIT ?
+    ''', (maintenant, taille)).fetchall()
+    if emails:
+        _prolonger_reservation(conn, emails)
+    conn.commit()
+    return emails
+
+def _construire_message(email):
+    """Construit le message MIME d'un email de la file"""
+    message = EmailMessage()
+    message['From'] = app.config['MAIL_SENDER']
+    message['To'] = email['destinataire']
+    message['Subject'] = email['sujet']
+    message.set_content(email['corps'])
+    return message
+
+def _ouvrir_connexion_smtp():
+    """Ouvre une connexion au serveur SMTP configuré"""
+    smtp = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'],
+                        timeout=app.config['MAIL_TIMEOUT'])
+    if app.config['MAIL_USE_TLS']:
+        smtp.starttls()
+    if app.config['MAIL_USERNAME']:
+        smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+    return smtp
+
+def _connexion_smtp_active(smtp):
+    """Vérifie qu'une connexion SMTP réutilisée répond toujours"""
+    try:
+        return smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+def _fermer_connexion_smtp(smtp):
+    """Ferme proprement une connexion SMTP"""
+    if smtp is None:
+        return
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+def _enregistrer_echec_email(conn, email, erreur, definitif=False):
+    """Reprogramme un email avec un délai croissant, ou le passe en lettres mortes"""
+    tentatives = email['tentatives'] + 1
+    if definitif or tentatives >= app.config['MAIL_MAX_TENTATIVES']:
+        conn.execute('''
+            INSERT INTO emails_echoues (id, destinataire, sujet, corps, tentatives, derniere_erreur, date_creation)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (email['id'], email['destinataire'], email['sujet'], email['corps'],
+              tentatives, str(erreur), email['date_creation']))
+        conn.execute('DELETE FROM emails_en_attente WHERE id = ?', (email['id'],))
+        app.logger.error('Email %s abandonné après %s tentative(s) : %s',
+                         email['id'], tentatives, erreur)
+    else:
+        delai = app.config['MAIL_DELAI_BASE'] * 2 ** (tentatives - 1)
+        conn.execute('''
+            UPDATE emails_en_attente 
+            SET tentatives = ?, prochain_essai = ?, derniere_erreur = ? 
+            WHERE id = ?
+        ''', (tentatives, time.time() + delai, str(erreur), email['id']))
+        app.logger.warning('Échec de l\'envoi de l\'email %s (tentative %s), nouvel essai dans %ss : %s',
+                           email['id'], tentatives, delai, erreur)
+
+def envoyer_lot_emails(smtp=None):
+    """Envoie un lot d'emails dus.
+    
+    Retourne la connexion SMTP (à réutiliser pour le lot suivant) et le nombre
+    d'emails traités.
+    """
+    conn = get_db_connection()
+    try:
+        emails = _reserver_lot_emails(conn, app.config['MAIL_BATCH_SIZE'])
+        if not emails:
+            return smtp, 0
+        
+        try:
+            if smtp is None or not _connexion_smtp_active(smtp):
+                _fermer_connexion_smtp(smtp)
+                smtp = _ouvrir_connexion_smtp()
+        except (smtplib.SMTPException, OSError) as e:
+            # Serveur injoignable : tout le lot est reprogrammé
+            for email in emails:
+                _enregistrer_echec_email(conn, email, e)
+            conn.commit()
+            return None, len(emails)
+        
+        # Le résultat de chaque envoi est validé immédiatement (transaction
+        # courte) : un email déjà parti n'est jamais renvoyé si le lot est
+        # interrompu ou repris par un autre processus. La réservation des emails
+        # restants est prolongée du temps d'un envoi à chaque étape.
+        for index, email in enumerate(emails):
+            try:
+                smtp.send_message(_construire_message(email))
+            except ValueError as e:
+                # Adresse ou en-tête invalide : inutile de réessayer
+                _enregistrer_echec_email(conn, email, e, definitif=True)
+            except smtplib.SMTPResponseException as e:
+                _enregistrer_echec_email(conn, email, e, definitif=e.smtp_code >= 500)
+            except smtplib.SMTPRecipientsRefused as e:
+                definitif = all(code >= 500 for code, _ in e.recipients.values())
+                _enregistrer_echec_email(conn, email, e, definitif)
+            except (smtplib.SMTPException, OSError) as e:
+                # Connexion perdue : les emails restants seront repris au prochain lot
+                _enregistrer_echec_email(conn, email, e)
+                conn.executemany('UPDATE emails_en_attente SET prochain_essai = ? WHERE id = ?',
+                                 [(time.time(), reste['id']) for reste in emails[index + 1:]])
+                conn.commit()
+                _fermer_connexion_smtp(smtp)
+                return None, len(emails)
+            else:
+                conn.execute('DELETE FROM emails_en_attente WHERE id = ?', (email['id'],))
+            _prolonger_reservation(conn, emails[index + 1:])
+            conn.commit()
+        
+        return smtp, len(emails)
+    finally:
+        conn.close()
+
+def _boucle_expediteur():
+    """Boucle du thread d'envoi des emails"""
+    smtp = None
+    while True:
+        try:
+            smtp, traites = envoyer_lot_emails(smtp)
+        except Exception:
+            app.logger.exception('Erreur inattendue dans l\'expéditeur d\'emails')
+            _fermer_connexion_smtp(smtp)
+            smtp, traites = None, 0
+        
+        if traites == 0:
+            # File vide : on libère la connexion SMTP jusqu'au prochain email
+            _fermer_connexion_smtp(smtp)
+            smtp = None
+        
+        if traites < app.config['MAIL_BATCH_SIZE']:
+            _expediteur_reveil.wait(app.config['MAIL_POLL_INTERVAL'])
+            _expediteur_reveil.clear()
+
+def demarrer_expediteur():
+    """Démarre le thread d'envoi des emails s'il ne tourne pas déjà"""
+    global _expediteur_thread
+    if not app.config['MAIL_SERVER']:
+        return
+    with _expediteur_lock:
+        if _expediteur_thread is None or not _expediteur_thread.is_alive():
+            _expediteur_thread = threading.Thread(target=_boucle_expediteur,
+                                                  name='expediteur-emails',
+                                                  daemon=True)
+            _expediteur_thread.start()
+
+@app.before_request
+def verifier_expediteur():
+    """S'assure que l'expéditeur d'emails tourne dans le processus qui sert les requêtes"""
+    if _expediteur_thread is None or not _expediteur_thread.is_alive():
+        demarrer_expediteur()
+
 # ============================================
 # ROUTES PUBLIQUES (UTILISATEURS)
 # ============================================
@@ -198,8 +459,18 @@ def reservation():
             INSERT INTO reservations (nom, email, telephone, destination, classe, date)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (nom, email, telephone, destination, classe, date))
+        
+        # Email de confirmation (envoyé en arrière-plan)
+        mettre_email_en_attente(conn, email,
+            'Confirmation de votre demande de réservation',
+            f'Bonjour {nom},\n\n'
+            f'Nous avons bien reçu votre demande de réservation pour {destination} '
+            f'(classe {classe}) à la date du {date}.\n'
+            f'Elle sera traitée par notre équipe dans les plus brefs délais.\n\n'
+            f'L\'équipe de l\'Agence de Voyage')
         conn.commit()
         conn.close()
+        reveiller_expediteur()
         
         flash('Votre réservation a été enregistrée avec succès !', 'success')
         return redirect(url_for('reservation'))
@@ -267,6 +538,203 @@ def tarifs():
     
     return render_template('tarifs.html', destinations=tarifs_list)
 
+# ============================================
+# API JSON (v1, LECTURE SEULE)
+# ============================================
+
+# Champs exposés par l'API pour chaque table (liste blanche)
+API_CHAMPS = {
+    'destinations': ('id', 'titre', 'description', 'prix', 'image_url'),
+    'commentaires': ('id', 'nom', 'message', 'date'),
+}
+API_LIMITE_DEFAUT = 50
+API_LIMITE_MAX = 200
+API_SEUIL_GZIP = 1024  # octets, en dessous la compression ne vaut pas le coût
+SQLITE_ENTIER_MIN = -2 ** 63
+SQLITE_ENTIER_MAX = 2 ** 63 - 1
+
+def _api_connexion():
+    """Connexion renvoyant des tuples bruts, sérialisés directement en tableaux JSON"""
+    conn = get_db_connection()
+    conn.row_factory = None
+    return conn
+
+def _api_champs_demandes(table):
+    """Lit le paramètre ?champs= (sélection de champs) et le valide"""
+    autorises = API_CHAMPS[table]
+    valeur = request.args.get('champs', '').strip()
+    if not valeur:
+        return list(autorises)
+    champs = list(dict.fromkeys(c.strip() for c in valeur.split(',') if c.strip()))
+    if not champs:
+        raise ValueError(f'Aucun champ indiqué (autorisés : {", ".join(autorises)})')
+    inconnus = [c for c in champs if c not in autorises]
+    if inconnus:
+        raise ValueError(f'Champs inconnus : {", ".join(inconnus)} '
+                         f'(autorisés : {", ".join(autorises)})')
+    return champs
+
+def _api_limite():
+    """Lit le paramètre ?limite= (taille de page)"""
+    try:
+        limite = int(request.args.get('limite', API_LIMITE_DEFAUT))
+    except ValueError:
+        raise ValueError('Le paramètre limite doit être un entier')
+    if not 1 <= limite <= API_LIMITE_MAX:
+        raise ValueError(f'Le paramètre limite doit être compris entre 1 et {API_LIMITE_MAX}')
+    return limite
+
+def _api_decoder_curseur(curseur, cles):
+    """Décode un curseur « valeur:...:id » selon les types des colonnes clés"""
+    morceaux = curseur.rsplit(':', len(cles) - 1)
+    if len(morceaux) != len(cles):
+        raise ValueError('Curseur de pagination invalide')
+    try:
+        valeurs = [type_(morceau) for (_, type_), morceau in zip(cles, morceaux)]
+    except ValueError:
+        raise ValueError('Curseur de pagination invalide')
+    for valeur in valeurs:
+        if isinstance(valeur, int) and not _api_entier_valide(valeur):
+            raise ValueError('Curseur de pagination invalide')
+        if isinstance(valeur, float) and not math.isfinite(valeur):
+            raise ValueError('Curseur de pagination invalide')
+    return valeurs
+
+def _api_entier_valide(valeur):
+    """Vérifie qu'un entier tient dans un INTEGER SQLite (64 bits signés)"""
+    return SQLITE_ENTIER_MIN <= valeur <= SQLITE_ENTIER_MAX
+
+def _api_page(table, filtre, cles, descendant=False):
+    """Renvoie une page de résultats, paginée par jeu de clés (keyset).
+    
+    Les colonnes clés sont ajoutées en fin de SELECT pour construire le curseur
+    suivant, puis retirées des lignes renvoyées.
+    """
+    champs = _api_champs_demandes(table)
+    limite = _api_limite()
+    colonnes_cles = [colonne for colonne, _ in cles]
+    
+    conditions = [filtre] if filtre else []
+    params = []
+    apres = request.args.get('apres')
+    if apres:
+        params.extend(_api_decoder_curseur(apres, cles))
+        conditions.append(f'({", ".join(colonnes_cles)}) {"<" if descendant else ">"} '
+                          f'({", ".join("?" * len(cles))})')
+    
+    sens = ' DESC' if descendant else ''
+    sql = f'SELECT {", ".join(champs + colonnes_cles)} FROM {table}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY ' + ', '.join(colonne + sens for colonne in colonnes_cles) + ' LIMIT ?'
+    params.append(limite + 1)
+    
+    conn = _api_connexion()
+    lignes = conn.execute(sql, params).fetchall()
+    conn.close()
+    
+    suivant = None
+    if len(lignes) > limite:
+        lignes = lignes[:limite]
+        suivant = ':'.join(str(valeur) for valeur in lignes[-1][len(champs):])
+    
+    nb_champs = len(champs)
+    return {
+        'champs': champs,
+        'donnees': [ligne[:nb_champs] for ligne in lignes],
+        'suivant': suivant,
+    }
+
+def _api_lot_destinations():
+    """Renvoie plusieurs destinations en un seul appel (?ids=1,2,3)"""
+    champs = _api_champs_demandes('destinations')
+    try:
+        ids = [int(i) for i in request.args['ids'].split(',') if i.strip()]
+    except ValueError:
+        raise ValueError('Le paramètre ids doit être une liste d\'entiers séparés par des virgules')
+    if not all(_api_entier_valide(i) for i in ids):
+        raise ValueError('Le paramètre ids contient un identifiant hors limites')
+    ids = list(dict.fromkeys(ids))
+    if not 1 <= len(ids) <= API_LIMITE_MAX:
+        raise ValueError(f'Le paramètre ids doit contenir entre 1 et {API_LIMITE_MAX} identifiants')
+    
+    conn = _api_connexion()
+    lignes = conn.execute(f'''
+        SELECT {", ".join(champs)}, id FROM destinations 
+        WHERE id IN ({", ".join("?" * len(ids))}) 
+        ORDER BY id
+    ''', ids).fetchall()
+    conn.close()
+    
+    trouves = {ligne[-1] for ligne in lignes}
+    nb_champs = len(champs)
+    return {
+        'champs': champs,
+        'donnees': [ligne[:nb_champs] for ligne in lignes],
+        'introuvables': [i for i in ids if i not in trouves],
+    }
+
+def _api_reponse(contenu):
+    """Sérialise une réponse de l'API avec ETag (304) et compression gzip"""
+    corps = json.dumps(contenu, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha1(corps).hexdigest()
+    
+    compresser = (len(corps) >= API_SEUIL_GZIP
+                  and request.accept_encodings['gzip'] > 0)
+    if compresser:
+        # Représentation distincte : ETag distinct
+        etag += '-gzip'
+    
+    if request.if_none_match.contains_weak(etag):
+        reponse = app.response_class(status=304)
+    else:
+        if compresser:
+            # mtime=0 : corps compressé identique d'une requête à l'autre (ETag fort)
+            corps = gzip.compress(corps, compresslevel=6, mtime=0)
+        reponse = app.response_class(corps, mimetype='application/json')
+        if compresser:
+            reponse.headers['Content-Encoding'] = 'gzip'
+    
+    reponse.set_etag(etag)
+    reponse.headers['Cache-Control'] = 'no-cache'
+    reponse.vary.add('Accept-Encoding')
+    return reponse
+
+def _api_erreur(message, code=400):
+    """Réponse d'erreur de l'API"""
+    return jsonify({'erreur': message}), code
+
+@app.route('/api/v1/destinations')
+def api_destinations():
+    """API : liste des destinations, ou lot d'identifiants avec ?ids="""
+    try:
+        if 'ids' in request.args:
+            contenu = _api_lot_destinations()
+        else:
+            contenu = _api_page('destinations', None, (('id', int),))
+    except ValueError as e:
+        return _api_erreur(str(e))
+    return _api_reponse(contenu)
+
+@app.route('/api/v1/tarifs')
+def api_tarifs():
+    """API : destinations triées par prix croissant"""
+    try:
+        contenu = _api_page('destinations', None, (('prix', float), ('id', int)))
+    except ValueError as e:
+        return _api_erreur(str(e))
+    return _api_reponse(contenu)
+
+@app.route('/api/v1/commentaires')
+def api_commentaires():
+    """API : commentaires approuvés, du plus récent au plus ancien"""
+    try:
+        contenu = _api_page('commentaires', 'approuve = 1', (('date', str), ('id', int)),
+                            descendant=True)
+    except ValueError as e:
+        return _api_erreur(str(e))
+    return _api_reponse(contenu)
+
 # ============================================
 # ROUTES ADMINISTRATEUR
 # ============================================
@@ -382,10 +850,24 @@ def approuver_reservation(id):
         return redirect(url_for('admin_login'))
     
     conn = get_db_connection()
-    conn.execute('UPDATE reservations SET statut = ? WHERE id = ?', 
-                ('approuvee', id))
+    cursor = conn.execute('UPDATE reservations SET statut = ? WHERE id = ? AND statut IS NOT ?', 
+                         ('approuvee', id, 'approuvee'))
+    
+    # Prévenir le client une seule fois : seule l'approbation qui change
+    # effectivement le statut met un email en file
+    if cursor.rowcount == 1:
+        reservation_approuvee = conn.execute('SELECT * FROM reservations WHERE id = ?', 
+                                            (id,)).fetchone()
+        mettre_email_en_attente(conn, reservation_approuvee['email'],
+            'Votre réservation est confirmée',
+            f'Bonjour {reservation_approuvee["nom"]},\n\n'
+            f'Votre réservation pour {reservation_approuvee["destination"]} '
+            f'(classe {reservation_approuvee["classe"]}) à la date du {reservation_approuvee["date"]} '
+            f'a été approuvée.\n\n'
+            f'L\'équipe de l\'Agence de Voyage')
     conn.commit()
     conn.close()
+    reveiller_expediteur()
     
     flash('Réservation approuvée avec succès', 'success')
     return redirect(url_for('admin_reservations'))
@@ -0,0 +1,131 @@
+import gzip
+
+import pytest
+
+
+@pytest.fixture
+def module_app(tmp_path, monkeypatch):
+    # La base est créée dans un dossier temporaire, pas dans database.db
+    monkeypatch.chdir(tmp_path)
+    import app as module_app
+    module_app.init_db()
+    monkeypatch.setattr(module_app, 'demarrer_expediteur', lambda: None)
+    return module_app
+
+
+@pytest.fixture
+def client(module_app):
+    return module_app.app.test_client()
+
+
+def executer(module_app, sql, lignes):
+    conn = module_app.get_db_connection()
+    conn.executemany(sql, lignes)
+    conn.commit()
+    conn.close()
+
+
+def parcourir(client, url):
+    """Suit les curseurs « suivant » et renvoie toutes les pages"""
+    pages = []
+    curseur = None
+    while True:
+        reponse = client.get(url + (f'&apres={curseur}' if curseur else ''))
+        assert reponse.status_code == 200
+        pages.append(reponse.get_json())
+        curseur = pages[-1]['suivant']
+        if curseur is None:
+            return pages
+
+
+def test_tarifs_pagination_prix_egaux(module_app, client):
+    executer(module_app,
+             'INSERT INTO destinations (titre, description, prix) VALUES (?, ?, ?)',
+             [(f'Égalité {i}', 'Même prix', 899.99) for i in range(3)])
+
+    pages = parcourir(client, '/api/v1/tarifs?champs=id,prix&limite=2')
+
+    lignes = [ligne for page in pages for ligne in page['donnees']]
+    assert len(pages) >= 2
+    assert lignes == sorted(lignes, key=lambda ligne: (ligne[1], ligne[0]))
+    assert len({ligne[0] for ligne in lignes}) == 7
+
+
+def test_commentaires_pagination_dates_avec_deux_points(module_app, client):
+    executer(module_app,
+             'INSERT INTO commentaires (nom, message, date, approuve) VALUES (?, ?, ?, ?)',
+             [('A', 'un', '2024-05-01 10:00:00', 1),
+              ('B', 'deux', '2024-05-01 10:00:00', 1),
+              ('C', 'trois', '2024-05-02 08:30:00', 1),
+              ('D', 'non approuvé', '2024-05-03 08:30:00', 0)])
+
+    pages = parcourir(client, '/api/v1/commentaires?champs=nom&limite=2')
+
+    assert len(pages) == 2
+    assert pages[0]['suivant'] == '2024-05-01 10:00:00:2'
+    assert [ligne for page in pages for ligne in page['donnees']] == [['C'], ['B'], ['A']]
+
+
+def test_selection_des_champs(client):
+    donnees = client.get('/api/v1/destinations?champs=titre,prix,titre').get_json()
+    assert donnees['champs'] == ['titre', 'prix']
+    assert all(len(ligne) == 2 for ligne in donnees['donnees'])
+
+
+@pytest.mark.parametrize('requete', [
+    'destinations?champs=inconnu',
+    'destinations?champs=,',
+    'destinations?limite=0',
+    'destinations?ids=a,b',
+    'destinations?ids=99999999999999999999',
+    'destinations?apres=99999999999999999999',
+    'tarifs?apres=nan:1',
+    'tarifs?apres=inf:1',
+    'commentaires?apres=sans-identifiant',
+])
+def test_erreurs_json(client, requete):
+    reponse = client.get(f'/api/v1/{requete}')
+    assert reponse.status_code == 400
+    assert reponse.is_json
+    assert reponse.get_json()['erreur']
+
+
+def test_lot_destinations(client):
+    donnees = client.get('/api/v1/destinations?ids=1,99,2&champs=id,titre').get_json()
+    assert donnees['donnees'] == [[1, 'Paris, France'], [2, 'Tokyo, Japon']]
+    assert donnees['introuvables'] == [99]
+
+
+@pytest.mark.parametrize('prefixe', ['', 'W/'])
+def test_etag_304(client, prefixe):
+    reponse = client.get('/api/v1/destinations')
+    etag = reponse.headers['ETag']
+
+    reponse = client.get('/api/v1/destinations',
+                         headers={'If-None-Match': prefixe + etag})
+
+    assert reponse.status_code == 304
+    assert reponse.data == b''
+    assert reponse.headers['ETag'] == etag
+
+
+def test_gzip_selon_taille_et_accept_encoding(module_app, client):
+    # Corps trop petit : jamais compressé
+    reponse = client.get('/api/v1/destinations?champs=id',
+                         headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in reponse.headers
+    assert not reponse.headers['ETag'].endswith('-gzip"')
+
+    executer(module_app,
+             'INSERT INTO commentaires (nom, message, approuve) VALUES (?, ?, 1)',
+             [(f'Client {i}', 'Très beau voyage ' * 5) for i in range(20)])
+
+    brute = client.get('/api/v1/commentaires')
+    assert 'Content-Encoding' not in brute.headers
+    assert len(brute.data) >= module_app.API_SEUIL_GZIP
+
+    compressee = client.get('/api/v1/commentaires', headers={'Accept-Encoding': 'gzip'})
+    assert compressee.headers['Content-Encoding'] == 'gzip'
+    assert compressee.headers['ETag'].endswith('-gzip"')
+    assert 'Accept-Encoding' in compressee.headers['Vary']
+    assert gzip.decompress(compressee.data) == brute.data
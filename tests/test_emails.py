@@ -0,0 +1,177 @@
+import socket
+import time
+from email import message_from_bytes, policy
+
+import pytest
+from aiosmtpd.controller import Controller
+
+
+class ServeurSMTP:
+    """Serveur SMTP local qui conserve les messages reçus"""
+
+    def __init__(self):
+        self.messages = []
+        self.adresses_refusees = set()
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.adresses_refusees:
+            return '550 no such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+def port_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def module_app(tmp_path, monkeypatch):
+    # La base est créée dans un dossier temporaire, pas dans database.db
+    monkeypatch.chdir(tmp_path)
+    import app as module_app
+    module_app.init_db()
+    # Les tests appellent envoyer_lot_emails() eux-mêmes
+    monkeypatch.setattr(module_app, 'demarrer_expediteur', lambda: None)
+    monkeypatch.setitem(module_app.app.config, 'MAIL_SERVER', '127.0.0.1')
+    monkeypatch.setitem(module_app.app.config, 'MAIL_PORT', port_libre())
+    monkeypatch.setitem(module_app.app.config, 'MAIL_TIMEOUT', 5)
+    monkeypatch.setitem(module_app.app.config, 'MAIL_MAX_TENTATIVES', 2)
+    monkeypatch.setitem(module_app.app.config, 'MAIL_DELAI_BASE', 30)
+    return module_app
+
+
+@pytest.fixture
+def serveur(module_app):
+    handler = ServeurSMTP()
+    controller = Controller(handler, hostname='127.0.0.1',
+                            port=module_app.app.config['MAIL_PORT'])
+    controller.start()
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def client(module_app):
+    return module_app.app.test_client()
+
+
+def lire_message(envelope):
+    return message_from_bytes(envelope.content, policy=policy.default)
+
+
+def reserver(client, email='client@example.com'):
+    return client.post('/reservation', data={
+        'nom': 'Dupont',
+        'email': email,
+        'telephone': '0123456789',
+        'destination': 'Paris, France',
+        'classe': 'economique',
+        'date': '2030-06-01',
+    })
+
+
+def emails_en_attente(module_app):
+    conn = module_app.get_db_connection()
+    emails = conn.execute('SELECT * FROM emails_en_attente').fetchall()
+    conn.close()
+    return emails
+
+
+def emails_echoues(module_app):
+    conn = module_app.get_db_connection()
+    emails = conn.execute('SELECT * FROM emails_echoues').fetchall()
+    conn.close()
+    return emails
+
+
+def test_confirmation_envoyee(module_app, serveur, client):
+    reserver(client)
+    assert len(emails_en_attente(module_app)) == 1
+
+    smtp, traites = module_app.envoyer_lot_emails()
+    module_app._fermer_connexion_smtp(smtp)
+
+    assert traites == 1
+    assert [m.rcpt_tos for m in serveur.messages] == [['client@example.com']]
+    message = lire_message(serveur.messages[0])
+    assert message['Subject'] == 'Confirmation de votre demande de réservation'
+    assert 'Paris, France' in message.get_content()
+    assert emails_en_attente(module_app) == []
+
+
+def test_nouvel_essai_puis_lettres_mortes(module_app, client):
+    # Aucun serveur n'écoute sur le port configuré
+    reserver(client)
+
+    avant = time.time()
+    module_app._fermer_connexion_smtp(module_app.envoyer_lot_emails()[0])
+    email, = emails_en_attente(module_app)
+    assert email['tentatives'] == 1
+    assert email['prochain_essai'] >= avant + 30
+
+    # Pas encore dû : rien n'est tenté
+    assert module_app.envoyer_lot_emails()[1] == 0
+
+    conn = module_app.get_db_connection()
+    conn.execute('UPDATE emails_en_attente SET prochain_essai = 0')
+    conn.commit()
+    conn.close()
+    module_app._fermer_connexion_smtp(module_app.envoyer_lot_emails()[0])
+
+    assert emails_en_attente(module_app) == []
+    echec, = emails_echoues(module_app)
+    assert echec['tentatives'] == 2
+    assert echec['destinataire'] == 'client@example.com'
+
+
+def test_adresse_refusee_en_lettres_mortes(module_app, serveur, client):
+    serveur.adresses_refusees.add('inconnu@example.com')
+    reserver(client, email='inconnu@example.com')
+
+    module_app._fermer_connexion_smtp(module_app.envoyer_lot_emails()[0])
+
+    assert emails_en_attente(module_app) == []
+    echec, = emails_echoues(module_app)
+    assert echec['tentatives'] == 1
+    assert '550' in echec['derniere_erreur']
+
+
+def test_double_approbation_un_seul_email(module_app, serveur, client):
+    reserver(client)
+    module_app._fermer_connexion_smtp(module_app.envoyer_lot_emails()[0])
+
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+    conn = module_app.get_db_connection()
+    id_reservation = conn.execute('SELECT MAX(id) FROM reservations').fetchone()[0]
+    conn.close()
+    client.get(f'/admin/reservation/{id_reservation}/approuver')
+    client.get(f'/admin/reservation/{id_reservation}/approuver')
+
+    module_app._fermer_connexion_smtp(module_app.envoyer_lot_emails()[0])
+
+    sujets = [lire_message(m)['Subject'] for m in serveur.messages]
+    assert sujets == ['Confirmation de votre demande de réservation',
+                      'Votre réservation est confirmée']
+
+
+def test_reservation_du_lot_courte(module_app, client):
+    for i in range(3):
+        reserver(client, email=f'client{i}@example.com')
+
+    conn = module_app.get_db_connection()
+    avant = time.time()
+    emails = module_app._reserver_lot_emails(conn, module_app.app.config['MAIL_BATCH_SIZE'])
+    conn.close()
+
+    # Réservés le temps d'un envoi, pas du lot entier
+    assert len(emails) == 3
+    limite = avant + 2 * module_app._COMMANDES_SMTP_PAR_EMAIL * module_app.app.config['MAIL_TIMEOUT']
+    assert all(avant < email['prochain_essai'] <= limite + 1
+               for email in emails_en_attente(module_app))